@@ -0,0 +1,98 @@
+import os
+import sys
+import pytest
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+from fastapi.testclient import TestClient
+
+# Never answer the warm-up questions against the real services during tests
+os.environ["WARM_QUERIES_PATH"] = ""
+
+# main only needs these client SDKs for names it binds at import; every client it
+# would build is replaced by the session mocks below, so skip importing the real
+# packages. Must run before anything imports main.
+for _module in ("pinecone", "openai", "langchain_openai"):
+    sys.modules.setdefault(_module, MagicMock(name=_module))
+
+# Default LLM reply, built once and shared by every test that reaches the LLM
+_FAKE_AI_RESPONSE = SimpleNamespace(content="Based on the context, here's how to fix the issue...")
+
+
+@pytest.fixture(scope="session")
+def _patch_main():
+    """Replace main's embedding model, Pinecone index and LLM with mocks once per session"""
+    import main
+    
+    session_mocks = SimpleNamespace(
+        embedding_model=MagicMock(name="embedding_model"),
+        index=MagicMock(name="index"),
+        llm=MagicMock(name="llm")
+    )
+    session_mocks.llm.ainvoke = AsyncMock(return_value=_FAKE_AI_RESPONSE)
+    
+    originals = {name: getattr(main, name) for name in vars(session_mocks)}
+    for name, mock in vars(session_mocks).items():
+        setattr(main, name, mock)
+    
+    yield session_mocks
+    
+    for name, original in originals.items():
+        setattr(main, name, original)
+
+
+@pytest.fixture
+def mocks(_patch_main):
+    """Handles to the session-wide mocks; calls, return values and side effects are reset after each test"""
+    yield _patch_main
+    for mock in vars(_patch_main).values():
+        mock.reset_mock(return_value=True, side_effect=True)
+    _patch_main.llm.ainvoke.return_value = _FAKE_AI_RESPONSE
+
+
+@pytest.fixture(scope="session")
+def fake_answer():
+    """Answer text of the default LLM reply"""
+    return _FAKE_AI_RESPONSE.content
+
+
+@pytest.fixture(scope="session")
+def dummy_embedding():
+    """384-dimensional embedding returned by the mocked embedding model"""
+    return (0.1,) * 384
+
+
+def _matches(scores):
+    return {
+        'matches': [
+            {
+                'score': score,
+                'metadata': {
+                    'text': f'Test text about appliance repair {i}',
+                    'source': f'test{i}.pdf',
+                    'chunk_index': i
+                }
+            }
+            for i, score in enumerate(scores, start=1)
+        ]
+    }
+
+
+@pytest.fixture(scope="session")
+def high_score_matches():
+    """Pinecone response whose average score (55%) is above the fallback threshold"""
+    return _matches([0.6, 0.55, 0.5])
+
+
+@pytest.fixture(scope="session")
+def low_score_matches():
+    """Pinecone response whose average score (10%) is below the fallback threshold"""
+    return _matches([0.1, 0.12, 0.08])
+
+
+@pytest.fixture(scope="session")
+def client(_patch_main):
+    """Single TestClient for the whole session, so the app lifespan runs only once"""
+    from main import app
+    
+    with TestClient(app) as test_client:
+        yield test_client
@@ -1,16 +1,34 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from typing import Any, Callable, List, Optional, Tuple
 import os
+import json
+import asyncio
+import hashlib
+import io
+import itertools
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+import httpx
+import numpy as np
+import orjson
+import onnxruntime as ort
+from tokenizers import Tokenizer
 from dotenv import load_dotenv
 from pinecone import Pinecone
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain import hub
+from langchain_core.messages import HumanMessage
 from langchain_openai import ChatOpenAI
 from langfuse import Langfuse
 from langfuse.callback import CallbackHandler
+from models import QueryRequest, QueryResponse
 import logging
+import logging.handlers
+import atexit
+import queue
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +36,30 @@ logger = logging.getLogger(__name__)
 # Load environment variables (looks in current directory and parent directories)
 load_dotenv()
 
+
+def configure_logging():
+    """
+    Route log records through a queue to a background listener thread, so
+    request handlers never block on writing to stderr.
+    
+    Does nothing if the root logger is already configured.
+    """
+    if logging.getLogger().handlers:
+        return
+    
+    log_queue = queue.SimpleQueue()
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+        handlers=[logging.handlers.QueueHandler(log_queue)]
+    )
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    atexit.register(listener.stop)
+
+
+configure_logging()
+
 # Initialize FastAPI app with Swagger documentation
 app = FastAPI(
     title="ApplianceCare AI Assistant API",
@@ -25,7 +67,8 @@ app = FastAPI(
     version="1.0.0",
     docs_url="/docs",  # Swagger UI endpoint
     redoc_url="/redoc",  # ReDoc endpoint
-    openapi_url="/openapi.json"  # OpenAPI schema endpoint
+    openapi_url="/openapi.json",  # OpenAPI schema endpoint
+    default_response_class=ORJSONResponse  # Serialize responses with orjson (C implementation)
 )
 
 # Configure CORS
@@ -37,25 +80,511 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize embedding model
-embedding_model = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Directory holding the INT8 ONNX export of all-MiniLM-L6-v2 (see README)
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", os.path.join(BASE_DIR, "minilm_int8"))
+
+# Worker processes started by `python main.py` when WEB_CONCURRENCY is not set
+DEFAULT_WEB_CONCURRENCY = min(4, os.cpu_count() or 1)
+
+# CPU cores available to each worker for model inference, so the workers together
+# do not start more compute threads than the machine has cores. Workers learn the
+# worker count from WEB_CONCURRENCY (exported by `python main.py`, and also read
+# by `uvicorn --workers`); a process started without it gets every core.
+CPU_BUDGET = max(1, (os.cpu_count() or 1) // max(1, int(os.getenv("WEB_CONCURRENCY", "1"))))
+
+
+class OnnxMiniLMEmbeddings:
+    """
+    all-MiniLM-L6-v2 sentence embeddings served by ONNX Runtime.
+
+    Same interface as HuggingFaceEmbeddings: tokenizes with the exported
+    tokenizer, runs the quantized INT8 graph and mean-pools the last hidden state
+    over the attention mask, then L2-normalizes the result. Embeddings are
+    returned as float32 NumPy arrays rather than lists of Python floats.
+
+    Calls are spread round-robin over a pool of sessions, so several worker
+    threads can embed at the same time without queueing behind one session.
+    """
+
+    MAX_SEQ_LENGTH = 256  # same limit sentence-transformers applies to MiniLM
+
+    def __init__(self, model_dir: str, num_sessions: int = 1, threads_per_session: Optional[int] = None):
+        sess_options = ort.SessionOptions()
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        sess_options.intra_op_num_threads = threads_per_session or os.cpu_count() or 1
+        self.sessions = [
+            ort.InferenceSession(
+                os.path.join(model_dir, "model_quantized.onnx"),
+                sess_options=sess_options,
+                providers=["CPUExecutionProvider"]
+            )
+            for _ in range(num_sessions)
+        ]
+        # next() on itertools.count is atomic under the GIL
+        self._session_counter = itertools.count()
+        self.input_names = {model_input.name for model_input in self.sessions[0].get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=self.MAX_SEQ_LENGTH)
+        self.tokenizer.enable_padding()
+
+    def embed_documents(self, texts: List[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        feeds = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": attention_mask
+        }
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+
+        session = self.sessions[next(self._session_counter) % len(self.sessions)]
+        last_hidden_state = session.run(None, feeds)[0]
+
+        # Mean pooling over real (non-padding) tokens
+        mask = attention_mask[:, :, None].astype(np.float32)
+        pooled = (last_hidden_state * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        # Clipped so a degenerate all-zero vector stays zero instead of becoming NaN
+        pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled.astype(np.float32, copy=False)
+
+    def embed_query(self, text: str) -> np.ndarray:
+        return self.embed_documents([text])[0]
+
+
+@lru_cache(maxsize=None)
+def get_embedding_model():
+    """Build the query embedding model (once per process)."""
+    if os.path.exists(os.path.join(ONNX_MODEL_DIR, "model_quantized.onnx")):
+        # Split this worker's cores into sessions of up to 4 threads each
+        threads_per_session = int(os.getenv("ONNX_THREADS_PER_SESSION", min(4, CPU_BUDGET)))
+        return OnnxMiniLMEmbeddings(
+            ONNX_MODEL_DIR,
+            num_sessions=int(os.getenv("ONNX_SESSIONS", max(2, CPU_BUDGET // threads_per_session))),
+            threads_per_session=threads_per_session
+        )
+    
+    # Fall back to the PyTorch model if the ONNX export has not been generated yet
+    import torch
+    from langchain_huggingface import HuggingFaceEmbeddings
+    
+    logger.warning("ONNX model not found in %s - using HuggingFaceEmbeddings", ONNX_MODEL_DIR)
+    torch.set_num_threads(CPU_BUDGET)
+    torch.set_num_interop_threads(1)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2", model_kwargs={"device": device})
+    if device == "cuda":
+        # FP16 roughly doubles throughput on Tensor Core GPUs; CPUs stay in FP32
+        embeddings.client.half()
+    
+    # Compile the encoder for fused kernels; dynamic shapes avoid recompiling for
+    # every query length. Compilation is triggered here rather than on the first
+    # request, and the eager model is kept if it fails (e.g. no C++ toolchain).
+    # dynamic=True still specializes dimensions of size 1, so a multi-query batch
+    # is warmed up too - otherwise the first micro-batch would recompile mid-request.
+    transformer = embeddings.client[0]
+    eager_model = transformer.auto_model
+    try:
+        transformer.auto_model = torch.compile(eager_model, dynamic=True)
+        embeddings.embed_query("warm up")
+        embeddings.embed_documents(["warm up", "warm up the batched path"])
+    except Exception as e:
+        logger.warning("torch.compile failed - using the eager PyTorch model: %s", e)
+        transformer.auto_model = eager_model
+    
+    return embeddings
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent single-item calls into one call of a batch function.
+
+    The first submitted item opens a window of `window` seconds; the pending items
+    are flushed as one batch when the window closes or `max_batch` items are waiting.
+    `batch_fn` runs in a worker thread and must return one result per input, in order.
+    """
+
+    def __init__(self, batch_fn: Callable[[List[Any]], List[Any]], window: float = 0.01, max_batch: int = 32):
+        self.batch_fn = batch_fn
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: List[Tuple[Any, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._running = set()
+
+    async def submit(self, item: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        
+        batch, self._pending = self._pending, []
+        if batch:
+            # Keep a reference so the task is not garbage collected mid-flight
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: List[Tuple[Any, asyncio.Future]]) -> None:
+        try:
+            results = await asyncio.to_thread(self.batch_fn, [item for item, _ in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(f"Batch function returned {len(results)} results for {len(batch)} inputs")
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+def _embed_batch(texts: List[str]):
+    embeddings = embedding_model.embed_documents(texts)
+    # Already on the batcher's worker thread, so store the new embeddings here
+    # rather than on the event loop
+    embedding_cache.put_many(texts, embeddings)
+    return embeddings
+
+
+# Queries arriving within the same window share a single embedding forward pass
+embedding_batcher = MicroBatcher(
+    _embed_batch,
+    window=float(os.getenv("EMBED_BATCH_WINDOW_MS", "10")) / 1000,
+    max_batch=int(os.getenv("EMBED_BATCH_SIZE", "32"))
+)
+
+
+class EmbeddingKVCache:
+    """
+    Persistent exact-match cache of query embeddings, stored in SQLite.
 
-prompt = hub.pull("rlm/rag-prompt")
+    Entries are keyed by the SHA-256 of the normalized (lower-cased,
+    whitespace-collapsed) query text - MiniLM is uncased, so this does not change
+    the embedding - and vectors are stored as float32 bytes. The database is
+    opened on first use, and once it holds more than `max_entries` rows the least
+    recently used ones are evicted.
+
+    Lookups only read, so they never wait on another worker's write; the
+    last-used times of hits are written with the next batch of stored embeddings.
+
+    Every method does disk I/O, so call them from a worker thread. SQLite errors
+    (unwritable directory, locked database, full disk) are logged and treated as
+    cache misses.
+    """
+
+    PRUNE_EVERY = 256  # stored embeddings between eviction passes
+    BUSY_TIMEOUT = 0.1  # seconds to wait for another worker's lock before giving up
+
+    def __init__(self, path: str, max_entries: int = 50000):
+        self.path = path
+        self.max_entries = max_entries
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._puts_since_prune = 0
+        self._touched = {}  # sha -> last lookup time, not yet written
+
+    @staticmethod
+    def key(text: str) -> bytes:
+        return hashlib.sha256(" ".join(text.lower().split()).encode("utf-8")).digest()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.BUSY_TIMEOUT, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(sha BLOB PRIMARY KEY, vec BLOB NOT NULL, last_used REAL NOT NULL DEFAULT 0)"
+            )
+            # Caches written before eviction was added have no last_used column
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(embeddings)")}
+            if "last_used" not in columns:
+                conn.execute("ALTER TABLE embeddings ADD COLUMN last_used REAL NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        sha = self.key(text)
+        try:
+            with self._lock:
+                row = self._connection().execute(
+                    "SELECT vec FROM embeddings WHERE sha = ?", (sha,)
+                ).fetchone()
+                if row:
+                    self._touched[sha] = time.time()
+        except sqlite3.Error as e:
+            logger.warning("Embedding cache lookup failed: %s", e)
+            return None
+        return np.frombuffer(row[0], dtype=np.float32) if row else None
+
+    def put_many(self, texts: List[str], embeddings) -> None:
+        now = time.time()
+        rows = [
+            (self.key(text), np.asarray(embedding, dtype=np.float32).tobytes(), now)
+            for text, embedding in zip(texts, embeddings)
+        ]
+        try:
+            with self._lock:
+                touched, self._touched = self._touched, {}
+                conn = self._connection()
+                with conn:
+                    conn.executemany(
+                        "UPDATE embeddings SET last_used = ? WHERE sha = ?",
+                        [(used, sha) for sha, used in touched.items()]
+                    )
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO embeddings (sha, vec, last_used) VALUES (?, ?, ?)", rows
+                    )
+                    self._puts_since_prune += len(rows)
+                    if self._puts_since_prune >= self.PRUNE_EVERY:
+                        conn.execute(
+                            "DELETE FROM embeddings WHERE sha IN "
+                            "(SELECT sha FROM embeddings ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                            (self.max_entries,)
+                        )
+                        self._puts_since_prune = 0
+        except sqlite3.Error as e:
+            logger.warning("Embedding cache store failed: %s", e)
+            # Keep the last-used times for the next store; newer lookups win
+            with self._lock:
+                self._touched = {**touched, **self._touched}
+
+    def put(self, text: str, embedding) -> None:
+        self.put_many([text], [embedding])
+
+
+# Embeddings of previously seen query text, kept across restarts
+embedding_cache = EmbeddingKVCache(
+    os.getenv("EMBEDDING_CACHE_PATH", os.path.join(BASE_DIR, "embedding_cache.sqlite3")),
+    max_entries=int(os.getenv("EMBEDDING_CACHE_SIZE", "50000"))
+)
+
+
+class SemanticCache:
+    """
+    Cache of generated answers keyed on the query embedding.
+
+    Embeddings are stored unit-normalized in a fixed-size ring buffer, so a lookup
+    is a single matrix-vector product (cosine similarity against every entry) and
+    inserting past capacity overwrites the oldest entry.
+    """
+
+    def __init__(self, dim: int = 384, threshold: float = 0.97, max_entries: int = 4096):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._embeddings = np.zeros((max_entries, dim), dtype=np.float32)
+        self._answers: List[Optional[str]] = [None] * max_entries
+        self._scores: List[float] = [0.0] * max_entries
+        self._size = 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._size
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def get(self, embedding) -> Optional[Tuple[str, float]]:
+        """Return (answer, total_score) of the most similar cached query, if close enough."""
+        query = self._normalize(embedding)
+        with self._lock:
+            if not self._size:
+                return None
+            similarities = self._embeddings[:self._size] @ query
+            best = int(np.argmax(similarities))
+            # Written so a NaN similarity is a miss
+            if not similarities[best] >= self.threshold:
+                return None
+            return self._answers[best], self._scores[best]
+
+    def put(self, embedding, answer: str, total_score: float) -> None:
+        with self._lock:
+            self._embeddings[self._next] = self._normalize(embedding)
+            self._answers[self._next] = answer
+            self._scores[self._next] = total_score
+            self._next = (self._next + 1) % self.max_entries
+            self._size = min(self._size + 1, self.max_entries)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._size = 0
+            self._next = 0
+
+
+# Answers for near-identical questions are served without hitting Pinecone or OpenAI
+semantic_cache = SemanticCache(
+    threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.97")),
+    max_entries=int(os.getenv("SEMANTIC_CACHE_SIZE", "4096"))
+)
+
+class WarmAnswerStore:
+    """
+    Answers to the warm-up questions, shared by all workers through SQLite.
+
+    A question is answered by whichever worker claims it first; the other workers
+    load the stored answer instead of calling Pinecone and OpenAI themselves.
+    Answers older than `max_age` seconds, and claims left unanswered for
+    `claim_timeout` seconds (e.g. the worker died), are up for claiming again.
+
+    Every method does disk I/O, so call them from a worker thread. SQLite errors
+    are logged; a failed claim counts as won, so the worker answers the question
+    itself.
+    """
+
+    def __init__(self, path: str, max_age: float, claim_timeout: float = 120.0):
+        self.path = path
+        self.max_age = max_age
+        self.claim_timeout = claim_timeout
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS warm_answers (query TEXT PRIMARY KEY, vec BLOB, "
+                "answer TEXT, total_score REAL, updated_at REAL NOT NULL)"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, query: str) -> Optional[Tuple[Optional[np.ndarray], Optional[str], float]]:
+        """Return (embedding, answer, total_score) if the question has a fresh result."""
+        try:
+            with self._lock:
+                row = self._connection().execute(
+                    "SELECT vec, answer, total_score FROM warm_answers "
+                    "WHERE query = ? AND total_score IS NOT NULL AND updated_at >= ?",
+                    (query, time.time() - self.max_age)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("Warm answer lookup failed: %s", e)
+            return None
+        if row is None:
+            return None
+        vec, answer, total_score = row
+        return (np.frombuffer(vec, dtype=np.float32) if vec else None), answer, total_score
+
+    def claim(self, query: str) -> bool:
+        """Claim a question for this worker to answer; False if another worker holds it."""
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connection()
+                with conn:
+                    cursor = conn.execute(
+                        "INSERT INTO warm_answers (query, updated_at) VALUES (?, ?) "
+                        "ON CONFLICT (query) DO UPDATE SET vec = NULL, answer = NULL, "
+                        "total_score = NULL, updated_at = excluded.updated_at "
+                        "WHERE (total_score IS NULL AND updated_at < ?) "
+                        "OR (total_score IS NOT NULL AND updated_at < ?)",
+                        (query, now, now - self.claim_timeout, now - self.max_age)
+                    )
+            return cursor.rowcount == 1
+        except sqlite3.Error as e:
+            logger.warning("Warm answer claim failed: %s", e)
+            return True
+
+    def put(self, query: str, embedding, answer: Optional[str], total_score: float) -> None:
+        """Store the result for a claimed question (`answer` is None if there is nothing to cache)."""
+        vector = np.asarray(embedding, dtype=np.float32).tobytes() if answer else None
+        try:
+            with self._lock:
+                conn = self._connection()
+                with conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO warm_answers "
+                        "(query, vec, answer, total_score, updated_at) VALUES (?, ?, ?, ?, ?)",
+                        (query, vector, answer, total_score, time.time())
+                    )
+        except sqlite3.Error as e:
+            logger.warning("Warm answer store failed: %s", e)
+
+    def release(self, query: str) -> None:
+        """Drop this worker's claim on a question it could not answer."""
+        try:
+            with self._lock:
+                conn = self._connection()
+                with conn:
+                    conn.execute("DELETE FROM warm_answers WHERE query = ? AND total_score IS NULL", (query,))
+        except sqlite3.Error as e:
+            logger.warning("Warm answer release failed: %s", e)
+
+
+# Snapshot of the "rlm/rag-prompt" template from LangChain Hub
+RAG_PROMPT_PATH = os.path.join(BASE_DIR, "rag_prompt.txt")
+
+
+def load_prompt_template() -> str:
+    """
+    Load the RAG prompt template as a plain format string.
+
+    Reads the snapshot shipped with the repo; if it is missing, pulls the prompt
+    from LangChain Hub once and writes the snapshot for subsequent starts.
+    """
+    if os.path.exists(RAG_PROMPT_PATH):
+        with open(RAG_PROMPT_PATH, encoding="utf-8") as f:
+            return f.read().rstrip("\n")
+    
+    template = hub.pull("rlm/rag-prompt").messages[0].prompt.template
+    with open(RAG_PROMPT_PATH, "w", encoding="utf-8") as f:
+        f.write(template + "\n")
+    return template
+
+
+PROMPT_TEMPLATE = load_prompt_template()
+if logger.isEnabledFor(logging.DEBUG):
+    logger.debug("RAG prompt template:\n%s", PROMPT_TEMPLATE)
 
 # Initialize Pinecone
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 if not PINECONE_API_KEY:
     raise ValueError("PINECONE_API_KEY not found in environment variables")
 
-pc = Pinecone(api_key=PINECONE_API_KEY)
-index = pc.Index("appliance-care-data")
+
+@lru_cache(maxsize=None)
+def get_index():
+    """
+    Connect to the Pinecone index (once per process).
+    
+    All requests share this client and so its urllib3 keep-alive pool (the SDK
+    sizes it at 5 connections per CPU by default).
+    """
+    pc = Pinecone(api_key=PINECONE_API_KEY)
+    return pc.Index("appliance-care-data")
+
 
 # Initialize OpenAI
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if not OPENAI_API_KEY:
     raise ValueError("OPENAI_API_KEY not found in environment variables")
 
-# Initialize Langfuse
+# Initialize Langfuse (set ENABLE_LANGFUSE=0 to turn tracing off even when keys are set)
+ENABLE_LANGFUSE = os.getenv("ENABLE_LANGFUSE", "1") == "1"
 LANGFUSE_SECRET_KEY = os.getenv("LANGFUSE_SECRET_KEY")
 LANGFUSE_PUBLIC_KEY = os.getenv("LANGFUSE_PUBLIC_KEY")
 LANGFUSE_HOST = os.getenv("LANGFUSE_HOST", "https://cloud.langfuse.com")
@@ -63,7 +592,9 @@ LANGFUSE_HOST = os.getenv("LANGFUSE_HOST", "https://cloud.langfuse.com")
 # Initialize Langfuse client and callback handler if keys are provided
 langfuse_client = None
 langfuse_handler = None
-if LANGFUSE_SECRET_KEY and LANGFUSE_PUBLIC_KEY:
+if not ENABLE_LANGFUSE:
+    logger.info("Langfuse disabled by ENABLE_LANGFUSE - LLM observability disabled")
+elif LANGFUSE_SECRET_KEY and LANGFUSE_PUBLIC_KEY:
     langfuse_client = Langfuse(
         secret_key=LANGFUSE_SECRET_KEY,
         public_key=LANGFUSE_PUBLIC_KEY,
@@ -78,55 +609,346 @@ if LANGFUSE_SECRET_KEY and LANGFUSE_PUBLIC_KEY:
 else:
     logger.warning("Langfuse keys not found - LLM observability disabled")
 
-# Initialize OpenAI Chat model
-llm = ChatOpenAI(
-    model_name="gpt-3.5-turbo",  # You can change to "gpt-4" or "gpt-4-turbo" if needed
-    temperature=0.7,
-    api_key=OPENAI_API_KEY,
-    callbacks=[langfuse_handler] if langfuse_handler else None
+
+@lru_cache(maxsize=None)
+def get_llm():
+    """Build the OpenAI chat model (once per process)."""
+    # Shared keep-alive connection pool, so requests reuse open TLS connections
+    http_async_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_keepalive_connections=int(os.getenv("OPENAI_MAX_CONNECTIONS", "100")),
+            max_connections=int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+        )
+    )
+    
+    return ChatOpenAI(
+        model_name="gpt-3.5-turbo",  # You can change to "gpt-4" or "gpt-4-turbo" if needed
+        temperature=0.7,
+        api_key=OPENAI_API_KEY,
+        http_async_client=http_async_client,
+        callbacks=[langfuse_handler] if langfuse_handler else None
+    )
+
+
+# Common questions answered at startup to pre-populate the semantic cache
+# (set to an empty string to disable warm-up)
+WARM_QUERIES_PATH = os.getenv("WARM_QUERIES_PATH", os.path.join(BASE_DIR, "warm_queries.json"))
+WARM_UP_CONCURRENCY = 8
+# How long a worker waits for another worker's warm-up answer before giving up
+WARM_UP_TIMEOUT = 120.0
+
+# Warm-up answers are stored next to the embedding cache and shared by all
+# workers, so each question costs one OpenAI call per WARM_ANSWER_MAX_AGE_HOURS
+warm_answer_store = WarmAnswerStore(
+    embedding_cache.path,
+    max_age=float(os.getenv("WARM_ANSWER_MAX_AGE_HOURS", "24")) * 3600,
+    claim_timeout=WARM_UP_TIMEOUT
 )
 
+# Number of Pinecone matches used as context
+TOP_K = 3
+
+# Total scores (%) below this get the fallback answer instead of an AI answer
+SCORE_THRESHOLD = 25.0
+
+# Queries shorter than this (after stripping whitespace) are rejected with a 400
+MIN_QUERY_LENGTH = 3
+
+FALLBACK_ANSWER = "I could not find enough information about this issue in the dataset."
+
+
+def validate_query(raw_query: str) -> str:
+    """Strip the query and reject empty/trivial ones before doing any model or network work."""
+    query = raw_query.strip()
+    if len(query) < MIN_QUERY_LENGTH:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Query must be at least {MIN_QUERY_LENGTH} characters long"
+        )
+    return query
+
+
+async def embed_query(query: str) -> np.ndarray:
+    """
+    Embed a query as a float32 vector, reusing the stored embedding if the same
+    text was seen before.
+    """
+    query_embedding = await asyncio.to_thread(embedding_cache.get, query)
+    if query_embedding is None:
+        # The batch function stores new embeddings in the cache
+        query_embedding = np.asarray(await embedding_batcher.submit(query), dtype=np.float32)
+    return query_embedding
+
 
-# Request/Response models
-class QueryRequest(BaseModel):
-    query: str
+def early_response(query_embedding: np.ndarray) -> Optional[QueryResponse]:
+    """Return a response that needs no Pinecone or OpenAI call, if there is one."""
+    # A (near) zero or non-finite vector carries no meaning - skip the Pinecone round-trip
+    if not np.isfinite(query_embedding).all() or np.linalg.norm(query_embedding) < 1e-3:
+        return QueryResponse(
+            answer=FALLBACK_ANSWER,
+            total_score=0.0
+        )
     
-    class Config:
-        json_schema_extra = {
-            "example": {
-                "query": "How to fix a washing machine that won't drain?"
-            }
-        }
+    # Serve previously answered, semantically equivalent questions from the cache
+    cached = semantic_cache.get(query_embedding)
+    if cached is not None:
+        cached_answer, cached_score = cached
+        return QueryResponse(
+            answer=cached_answer,
+            total_score=cached_score
+        )
+    
+    return None
 
 
-class SearchResult(BaseModel):
-    score: float
-    text: str
-    source: str
-    chunk_index: Optional[int] = None
-    
-    class Config:
-        json_schema_extra = {
-            "example": {
-                "score": 0.85,
-                "text": "To fix a washing machine that won't drain, first check the drain hose...",
-                "source": "All about repairing major household appliances.pdf",
-                "chunk_index": 1
-            }
-        }
+async def search_context(query_embedding: np.ndarray) -> Tuple[str, float]:
+    """
+    Search Pinecone for the top matches and build the RAG context.
+    
+    Returns the combined text of the matches and the total score
+    (average of the match scores * 100).
+    """
+    # Model inference and SDK calls block, so run them in worker threads to keep
+    # the event loop free to serve other requests
+    results = await asyncio.to_thread(
+        index.query,
+        vector=query_embedding.tolist(),  # the SDK only accepts plain lists
+        top_k=TOP_K,
+        include_metadata=True
+    )
+    
+    # Work directly off the match dicts - no per-match model validation. The
+    # context is written out and the scores summed in a single pass.
+    matches = results['matches']
+    context = io.StringIO()
+    score_sum = 0.0
+    for match in matches:
+        score_sum += float(match['score'])
+        text = (match['metadata'].get('text') or '').strip()
+        if text:
+            if context.tell():
+                context.write("\n\n")
+            context.write(text)
+    
+    # Calculate total score as percentage: (average of scores) * 100
+    total_score = (score_sum / len(matches)) * 100 if matches else 0.0
+    
+    return context.getvalue(), total_score
 
 
-class QueryResponse(BaseModel):
-    answer: Optional[str] = None
-    total_score: float
+async def retrieve(query: str) -> Tuple[np.ndarray, Optional[QueryResponse], str, float]:
+    """
+    Embed a validated query and search Pinecone for its context.
     
-    class Config:
-        json_schema_extra = {
-            "example": {
-                "answer": "Based on the provided context, here's how to fix a washing machine that won't drain...",
-                "total_score": 53.3
-            }
-        }
+    Returns (query_embedding, response, context, total_score). `response` is set
+    when the query is answered without the LLM: a degenerate embedding, a
+    semantic cache hit, or a total score below SCORE_THRESHOLD.
+    """
+    query_embedding = await embed_query(query)
+    
+    response = early_response(query_embedding)
+    if response is not None:
+        return query_embedding, response, "", response.total_score
+    
+    context, total_score = await search_context(query_embedding)
+    
+    # Not relevant enough to answer from - return the fallback message
+    if total_score < SCORE_THRESHOLD:
+        response = QueryResponse(
+            answer=FALLBACK_ANSWER,
+            total_score=total_score
+        )
+    
+    return query_embedding, response, context, total_score
+
+
+def build_messages(query: str, context: str) -> List[HumanMessage]:
+    """Format the RAG prompt with the query and context."""
+    return [HumanMessage(content=PROMPT_TEMPLATE.format(question=query, context=context))]
+
+
+async def answer_query(query: str) -> QueryResponse:
+    """
+    Answer a validated query: embed it, search Pinecone and generate the AI answer.
+    
+    Errors from embedding or Pinecone propagate; an OpenAI failure yields a
+    response without an answer.
+    """
+    query_embedding, response, context, total_score = await retrieve(query)
+    if response is not None:
+        return response
+    
+    # Format the prompt with query and context
+    ai_answer = None
+    # trace = None
+    
+    try:
+        messages = build_messages(query, context)
+        
+        # Create Langfuse trace for this query
+        # if langfuse_client:
+        #     trace = langfuse_client.trace(
+        #         name="appliance_repair_query",
+        #         tags=["rag", "appliance-care"],
+        #         metadata={
+        #             "query": query,
+        #             "total_score": total_score,
+        #             "top_k": TOP_K
+        #         }
+        #     )
+        #     
+        #     # Log Pinecone search as a span
+        #     trace.span(
+        #         name="pinecone_search",
+        #         metadata={
+        #             "query": query,
+        #             "total_score": total_score,
+        #             "context_length": len(context)
+        #         }
+        #     )
+        
+        # Call OpenAI API with the formatted messages
+        # The callback handler will automatically track the LLM call
+        response = await llm.ainvoke(messages)
+        
+        # Extract the answer from the response
+        if hasattr(response, 'content'):
+            ai_answer = response.content
+        else:
+            ai_answer = str(response)
+        
+        if ai_answer:
+            semantic_cache.put(query_embedding, ai_answer, total_score)
+        
+        # Log OpenAI generation metadata
+        # if trace:
+        #     trace.span(
+        #         name="openai_generation",
+        #         metadata={
+        #             "model": "gpt-3.5-turbo",
+        #             "answer_length": len(ai_answer) if ai_answer else 0,
+        #             "total_score": total_score,
+        #             "context_length": len(context)
+        #         }
+        #     )
+        
+        # Update trace with output
+        # if trace:
+        #     trace.update(
+        #         output={
+        #             "answer": ai_answer,
+        #             "total_score": total_score
+        #         }
+        #     )
+        
+    except Exception as e:
+        logger.error("Error calling OpenAI API: %s", e)
+        
+        # Log error to Langfuse
+        # if trace:
+        #     trace.update(
+        #         level="ERROR",
+        #         status_message=str(e)
+        #     )
+        # Continue without AI answer if OpenAI fails
+    
+    return QueryResponse(
+        answer=ai_answer,
+        total_score=total_score
+    )
+
+
+def sse_event(event: str, data: dict) -> str:
+    """Format a Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+
+# The embedding model, Pinecone index and LLM are bound per worker on startup,
+# so the supervisor process run by `python main.py` with several workers never
+# loads them itself
+embedding_model = None
+index = None
+llm = None
+
+
+@app.on_event("startup")
+async def load_clients():
+    """
+    Bind the embedding model, Pinecone index and OpenAI chat model for this worker.
+    
+    Clients that are already bound (e.g. replaced by tests) are left as they are.
+    """
+    global embedding_model, index, llm
+    if embedding_model is None:
+        embedding_model = get_embedding_model()
+    if index is None:
+        index = get_index()
+    if llm is None:
+        llm = get_llm()
+
+
+@app.on_event("startup")
+async def warm_semantic_cache():
+    """
+    Load answers to the common questions in warm_queries.json into the semantic
+    cache at startup, so users asking them are served from it from the first request.
+    
+    The answers are shared between workers through `warm_answer_store`: each
+    question is answered by one worker and loaded by the others.
+    """
+    if not WARM_QUERIES_PATH or not os.path.exists(WARM_QUERIES_PATH):
+        return
+    
+    with open(WARM_QUERIES_PATH, encoding="utf-8") as f:
+        warm_queries = json.load(f)
+    
+    semaphore = asyncio.Semaphore(WARM_UP_CONCURRENCY)
+    answered = 0
+    
+    async def warm(query: str):
+        nonlocal answered
+        deadline = time.monotonic() + WARM_UP_TIMEOUT
+        while True:
+            stored = await asyncio.to_thread(warm_answer_store.get, query)
+            if stored is not None:
+                embedding, answer, total_score = stored
+                if answer:
+                    semantic_cache.put(embedding, answer, total_score)
+                return
+            
+            # Claim only once a slot is free, so no claim expires while queued here
+            async with semaphore:
+                if await asyncio.to_thread(warm_answer_store.claim, query):
+                    try:
+                        response = await answer_query(query)
+                        if response.answer is None:
+                            raise RuntimeError("no answer from OpenAI")
+                        query_embedding = await embed_query(query)
+                    except Exception as e:
+                        # Leave the question for another worker to try
+                        logger.warning("Cache warm-up failed for %r: %s", query, e)
+                        await asyncio.to_thread(warm_answer_store.release, query)
+                        return
+                    answered += 1
+                    # Fallback answers are not cached by answer_query, so none is shared
+                    answer = response.answer if response.answer != FALLBACK_ANSWER else None
+                    await asyncio.to_thread(
+                        warm_answer_store.put, query, query_embedding, answer, response.total_score
+                    )
+                    return
+            
+            # Another worker is answering it
+            if time.monotonic() >= deadline:
+                logger.warning("Timed out waiting for the warm-up answer to %r", query)
+                return
+            await asyncio.sleep(1)
+    
+    start = time.perf_counter()
+    await asyncio.gather(*(warm(query) for query in warm_queries))
+    logger.info(
+        "Semantic cache warmed: cache_size=%d answered_here=%d in %.1fs",
+        len(semantic_cache), answered, time.perf_counter() - start
+    )
 
 
 @app.get("/", tags=["General"])
@@ -177,136 +999,76 @@ async def query_pinecone(request: QueryRequest):
     }
     ```
     """
+    query = validate_query(request.query)
+    
     try:
-        # Default top_k is 3
-        TOP_K = 3
-        
-        # Generate embedding for the query
-        query_embedding = embedding_model.embed_query(request.query)
-        
-        # Search Pinecone
-        results = index.query(
-            vector=query_embedding,
-            top_k=TOP_K,
-            include_metadata=True
-        )
-        
-        # Format results
-        search_results = []
-        for match in results['matches']:
-            search_results.append(SearchResult(
-                score=float(match['score']),
-                text=match['metadata'].get('text', ''),
-                source=match['metadata'].get('source', ''),
-                chunk_index=match['metadata'].get('chunk_index')
-            ))
-        
-        # Combine all text from results into a single context
-        context_parts = []
-        for result in search_results:
-            if result.text.strip():
-                context_parts.append(result.text.strip())
-        
-        context = "\n\n".join(context_parts)
-        
-        # Calculate total score as percentage: (average of scores) * 100
-        if search_results:
-            avg_score = sum(result.score for result in search_results) / len(search_results)
-            total_score = avg_score * 100
-        else:
-            total_score = 0.0
-        
-        # Check if score is less than 25% - return fallback message
-        if total_score < 25.0:
-            return QueryResponse(
-                answer="I could not find enough information about this issue in the dataset.",
-                total_score=total_score
-            )
+        return await answer_query(query)
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error querying database: {str(e)}")
+
+
+@app.post("/query/stream", tags=["Search"])
+async def query_pinecone_stream(request: QueryRequest):
+    """
+    Same as `/query`, but streams the AI-generated answer as Server-Sent Events.
+    
+    The relevance score is sent as soon as the Pinecone search completes, and the
+    answer follows token by token while OpenAI generates it.
+    
+    **Events:**
+    - **score**: `{"total_score": 53.3}` - always the first event
+    - **token**: `{"content": "..."}` - the next piece of the answer (cached and fallback answers arrive as a single token)
+    - **error**: `{"detail": "..."}` - the answer could not be generated
+    - **done**: `{}` - end of the stream
+    """
+    query = validate_query(request.query)
+    
+    try:
+        query_embedding, response, context, total_score = await retrieve(query)
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error querying database: {str(e)}")
+    
+    async def event_stream():
+        if response is not None:
+            yield sse_event("score", {"total_score": response.total_score})
+            yield sse_event("token", {"content": response.answer})
+            yield sse_event("done", {})
+            return
         
-        # Format the prompt with query and context
-        ai_answer = None
-        # trace = None
+        yield sse_event("score", {"total_score": total_score})
         
+        answer_parts = []
         try:
-            messages = prompt.format_messages(question=request.query, context=context)
-            
-            # Create Langfuse trace for this query
-            # if langfuse_client:
-            #     trace = langfuse_client.trace(
-            #         name="appliance_repair_query",
-            #         tags=["rag", "appliance-care"],
-            #         metadata={
-            #             "query": request.query,
-            #             "total_score": total_score,
-            #             "num_results": len(search_results),
-            #             "top_k": TOP_K
-            #         }
-            #     )
-            #     
-            #     # Log Pinecone search as a span
-            #     trace.span(
-            #         name="pinecone_search",
-            #         metadata={
-            #             "query": request.query,
-            #             "results_count": len(search_results),
-            #             "scores": [r.score for r in search_results],
-            #             "sources": [r.source for r in search_results]
-            #         }
-            #     )
-            
-            # Call OpenAI API with the formatted messages
-            # The callback handler will automatically track the LLM call
-            response = llm.invoke(messages)
-            
-            # Extract the answer from the response
-            if hasattr(response, 'content'):
-                ai_answer = response.content
-            else:
-                ai_answer = str(response)
-            
-            # Log OpenAI generation metadata
-            # if trace:
-            #     trace.span(
-            #         name="openai_generation",
-            #         metadata={
-            #             "model": "gpt-3.5-turbo",
-            #             "answer_length": len(ai_answer) if ai_answer else 0,
-            #             "total_score": total_score,
-            #             "context_length": len(context)
-            #         }
-            #     )
-            
-            # Update trace with output
-            # if trace:
-            #     trace.update(
-            #         output={
-            #             "answer": ai_answer,
-            #             "total_score": total_score
-            #         }
-            #     )
-            
+            async for chunk in llm.astream(build_messages(query, context)):
+                if chunk.content:
+                    answer_parts.append(chunk.content)
+                    yield sse_event("token", {"content": chunk.content})
         except Exception as e:
-            logger.error(f"Error calling OpenAI API: {e}")
-            print(f"Error calling OpenAI API: {e}")
-            
-            # Log error to Langfuse
-            # if trace:
-            #     trace.update(
-            #         level="ERROR",
-            #         status_message=str(e)
-            #     )
-            # Continue without AI answer if OpenAI fails
+            logger.error("Error streaming from OpenAI API: %s", e)
+            yield sse_event("error", {"detail": "Error generating answer"})
+        else:
+            if answer_parts:
+                semantic_cache.put(query_embedding, "".join(answer_parts), total_score)
         
-        return QueryResponse(
-            answer=ai_answer,
-            total_score=total_score
-        )
+        yield sse_event("done", {})
     
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error querying database: {str(e)}")
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Each worker imports "main:app" and loads its own models on startup; the
+    # workers inherit this environment, so they size CPU_BUDGET from it
+    workers = int(os.getenv("WEB_CONCURRENCY", DEFAULT_WEB_CONCURRENCY))
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=workers,
+        loop="uvloop",
+        http="httptools"
+    )
 
@@ -0,0 +1,32 @@
+"""
+Request/response models for the ApplianceCare AI Assistant API.
+
+Kept separate from main so they can be imported without loading the embedding
+model, Pinecone or OpenAI clients.
+"""
+from pydantic import BaseModel
+from typing import Optional
+
+
+class QueryRequest(BaseModel):
+    query: str
+    
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "query": "How to fix a washing machine that won't drain?"
+            }
+        }
+
+
+class QueryResponse(BaseModel):
+    answer: Optional[str] = None
+    total_score: float
+    
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "answer": "Based on the provided context, here's how to fix a washing machine that won't drain...",
+                "total_score": 53.3
+            }
+        }
@@ -1,229 +1,143 @@
+import asyncio
+import json
+import sqlite3
+import time
+import httpx
+import numpy as np
 import pytest
-from fastapi.testclient import TestClient
-from unittest.mock import Mock, patch, MagicMock
-import os
+from unittest.mock import Mock, patch, AsyncMock
+from types import SimpleNamespace
+import main
 from main import app
 
-# Create test client
-client = TestClient(app)
+# Fixed request bodies, encoded once instead of re-serialized on every post
+_Q_HEADERS = {"content-type": "application/json"}
+_Q_BODY = b'{"query": "Test question"}'
+_WASHER_Q_BODY = b'{"query": "How to fix a washing machine?"}'
+_UNRELATED_Q_BODY = b'{"query": "Completely unrelated question"}'
 
 
-class TestRootEndpoint:
-    """Tests for the root endpoint"""
-    
-    def test_root_endpoint(self):
-        """Test that root endpoint returns correct information"""
-        response = client.get("/")
-        assert response.status_code == 200
-        data = response.json()
-        assert data["message"] == "ApplianceCare AI Assistant API"
-        assert data["status"] == "running"
-        assert "docs" in data
-        assert "redoc" in data
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """Every test mocks the same embedding, so cached answers must not leak between tests"""
+    main.semantic_cache.clear()
+    with patch('main.embedding_cache', main.EmbeddingKVCache(":memory:")), \
+            patch('main.warm_answer_store', main.WarmAnswerStore(":memory:", max_age=3600)):
+        yield
+    main.semantic_cache.clear()
 
 
-class TestHealthEndpoint:
-    """Tests for the health check endpoint"""
+class TestGeneralEndpoints:
+    """Tests for the root and health check endpoints"""
     
-    def test_health_endpoint(self):
-        """Test that health endpoint returns healthy status"""
-        response = client.get("/health")
+    @pytest.mark.parametrize(
+        "path,expected",
+        [
+            ("/", {
+                "message": "ApplianceCare AI Assistant API",
+                "status": "running",
+                "docs": "/docs",
+                "redoc": "/redoc"
+            }),
+            ("/health", {"status": "healthy"}),
+        ],
+        ids=["root", "health"]
+    )
+    def test_get_endpoints(self, client, path, expected):
+        """Test that the GET endpoints return their status payload"""
+        response = client.get(path)
         assert response.status_code == 200
-        data = response.json()
-        assert data["status"] == "healthy"
+        assert response.json() == expected
+
+
+# (match scores, expected answer, expected total score) for the scoring tests
+SCORING_CASES = [
+    ([0.6, 0.55, 0.5], "answer_present", 55.0),
+    ([0.1, 0.12, 0.08], "fallback", 10.0),
+    ([], "fallback", 0.0),
+    ([0.5, 0.6, 0.4], "answer_present", 50.0),
+]
 
 
 class TestQueryEndpoint:
     """Tests for the query endpoint"""
     
-    @patch('main.llm')
-    @patch('main.index')
-    @patch('main.embedding_model')
-    def test_query_successful_high_score(self, mock_embedding, mock_index, mock_llm):
-        """Test successful query with high relevance score"""
-        # Mock embedding
-        mock_embedding.embed_query.return_value = [0.1] * 384
-        
-        # Mock Pinecone query response
-        mock_index.query.return_value = {
-            'matches': [
-                {
-                    'score': 0.6,
-                    'metadata': {
-                        'text': 'Test text about washing machine repair',
-                        'source': 'test.pdf',
-                        'chunk_index': 1
-                    }
-                },
-                {
-                    'score': 0.55,
-                    'metadata': {
-                        'text': 'More test text about appliances',
-                        'source': 'test2.pdf',
-                        'chunk_index': 2
-                    }
-                },
-                {
-                    'score': 0.5,
-                    'metadata': {
-                        'text': 'Additional repair information',
-                        'source': 'test3.pdf',
-                        'chunk_index': 3
-                    }
-                }
-            ]
-        }
-        
-        # Mock OpenAI response
-        mock_ai_response = MagicMock()
-        mock_ai_response.content = "Based on the context, here's how to fix the issue..."
-        mock_llm.invoke.return_value = mock_ai_response
-        
-        # Mock prompt format_messages
-        with patch('main.prompt') as mock_prompt:
-            mock_prompt.format_messages.return_value = [MagicMock()]
-            
-            response = client.post(
-                "/query",
-                json={"query": "How to fix a washing machine?"}
-            )
-        
-        assert response.status_code == 200
-        data = response.json()
-        assert "answer" in data
-        assert "total_score" in data
-        assert data["total_score"] > 25.0  # Should be above threshold
-        assert data["answer"] is not None
-        assert isinstance(data["total_score"], float)
-    
-    @patch('main.index')
-    @patch('main.embedding_model')
-    def test_query_low_score_fallback(self, mock_embedding, mock_index):
-        """Test query with low relevance score returns fallback message"""
+    @pytest.mark.parametrize(
+        "scores,expect,approx_score",
+        SCORING_CASES,
+        ids=["high_score", "low_score_fallback", "no_results", "average"]
+    )
+    def test_query_scoring(self, client, mocks, dummy_embedding, fake_answer, scores, expect, approx_score):
+        """Test that the score is the average match score as a percentage and gates the AI answer"""
         # Mock embedding
-        mock_embedding.embed_query.return_value = [0.1] * 384
+        mocks.embedding_model.embed_documents.side_effect = lambda texts: [dummy_embedding] * len(texts)
         
-        # Mock Pinecone query response with low scores
-        mock_index.query.return_value = {
+        # Mock Pinecone query response with the given scores
+        mocks.index.query.return_value = {
             'matches': [
                 {
-                    'score': 0.1,
-                    'metadata': {
-                        'text': 'Unrelated text',
-                        'source': 'test.pdf',
-                        'chunk_index': 1
-                    }
-                },
-                {
-                    'score': 0.12,
-                    'metadata': {
-                        'text': 'More unrelated text',
-                        'source': 'test2.pdf',
-                        'chunk_index': 2
-                    }
-                },
-                {
-                    'score': 0.08,
+                    'score': score,
                     'metadata': {
-                        'text': 'Even more unrelated',
-                        'source': 'test3.pdf',
-                        'chunk_index': 3
+                        'text': f'Text {i}',
+                        'source': f'test{i}.pdf',
+                        'chunk_index': i
                     }
                 }
+                for i, score in enumerate(scores, start=1)
             ]
         }
         
         response = client.post(
             "/query",
-            json={"query": "Completely unrelated question"}
+            content=_WASHER_Q_BODY,
+            headers=_Q_HEADERS
         )
         
         assert response.status_code == 200
         data = response.json()
-        assert data["answer"] == "I could not find enough information about this issue in the dataset."
-        assert data["total_score"] < 25.0
         assert isinstance(data["total_score"], float)
+        assert data["total_score"] == pytest.approx(approx_score, abs=0.01)
+        if expect == "answer_present":
+            assert data["answer"] == fake_answer
+        else:
+            assert data["answer"] == "I could not find enough information about this issue in the dataset."
+            mocks.llm.ainvoke.assert_not_called()
     
-    def test_query_missing_field(self):
-        """Test query with missing required field"""
-        response = client.post(
-            "/query",
-            json={}
-        )
-        assert response.status_code == 422  # Validation error
-    
-    def test_query_empty_string(self):
-        """Test query with empty string"""
-        response = client.post(
-            "/query",
-            json={"query": ""}
-        )
-        # Should still process but might return empty results
-        assert response.status_code in [200, 422]
-    
-    def test_query_invalid_json(self):
-        """Test query with invalid JSON"""
-        response = client.post(
-            "/query",
-            data="invalid json"
-        )
-        assert response.status_code == 422
-    
-    @patch('main.index')
-    @patch('main.embedding_model')
-    def test_query_no_results(self, mock_embedding, mock_index):
-        """Test query that returns no results"""
-        # Mock embedding
-        mock_embedding.embed_query.return_value = [0.1] * 384
-        
-        # Mock Pinecone query with no matches
-        mock_index.query.return_value = {
-            'matches': []
-        }
+    @pytest.mark.parametrize("value", [0.0, float("nan")], ids=["zero", "nan"])
+    def test_query_zero_embedding(self, client, mocks, value):
+        """Test that a degenerate embedding skips Pinecone and the cache and returns the fallback"""
+        # Mock a degenerate embedding, with an unrelated answer already cached
+        mocks.embedding_model.embed_documents.side_effect = lambda texts: [[value] * 384 for _ in texts]
+        main.semantic_cache.put([0.1] * 384, "cached answer for something else", 60.0)
         
         response = client.post(
             "/query",
-            json={"query": "Very specific question"}
+            content=_Q_BODY,
+            headers=_Q_HEADERS
         )
         
         assert response.status_code == 200
         data = response.json()
         assert data["total_score"] == 0.0
         assert data["answer"] == "I could not find enough information about this issue in the dataset."
+        mocks.index.query.assert_not_called()
     
-    @patch('main.llm')
-    @patch('main.index')
-    @patch('main.embedding_model')
-    def test_query_openai_error(self, mock_embedding, mock_index, mock_llm):
+    def test_query_openai_error(self, client, mocks, dummy_embedding, high_score_matches):
         """Test query when OpenAI API fails"""
         # Mock embedding
-        mock_embedding.embed_query.return_value = [0.1] * 384
+        mocks.embedding_model.embed_documents.side_effect = lambda texts: [dummy_embedding] * len(texts)
         
         # Mock Pinecone query response with good scores
-        mock_index.query.return_value = {
-            'matches': [
-                {
-                    'score': 0.6,
-                    'metadata': {
-                        'text': 'Test text',
-                        'source': 'test.pdf',
-                        'chunk_index': 1
-                    }
-                }
-            ]
-        }
+        mocks.index.query.return_value = high_score_matches
         
         # Mock OpenAI to raise an error
-        mock_llm.invoke.side_effect = Exception("OpenAI API error")
-        
-        # Mock prompt format_messages
-        with patch('main.prompt') as mock_prompt:
-            mock_prompt.format_messages.return_value = [MagicMock()]
-            
-            response = client.post(
-                "/query",
-                json={"query": "Test question"}
-            )
+        mocks.llm.ainvoke.side_effect = Exception("OpenAI API error")
+        
+        response = client.post(
+            "/query",
+            content=_Q_BODY,
+            headers=_Q_HEADERS
+        )
         
         # Should still return 200 but with None answer
         assert response.status_code == 200
@@ -231,19 +145,36 @@ class TestQueryEndpoint:
         assert data["total_score"] > 25.0
         assert data["answer"] is None  # OpenAI failed
     
-    @patch('main.index')
-    @patch('main.embedding_model')
-    def test_query_pinecone_error(self, mock_embedding, mock_index):
+    def test_query_semantic_cache_hit(self, client, mocks, dummy_embedding, high_score_matches):
+        """Test that a repeated query is answered from the semantic cache"""
+        # Mock embedding
+        mocks.embedding_model.embed_documents.side_effect = lambda texts: [dummy_embedding] * len(texts)
+        
+        # Mock Pinecone query response with good scores
+        mocks.index.query.return_value = high_score_matches
+        
+        first = client.post("/query", content=_Q_BODY, headers=_Q_HEADERS)
+        second = client.post("/query", content=_Q_BODY, headers=_Q_HEADERS)
+        
+        assert first.status_code == 200
+        assert second.status_code == 200
+        assert second.json() == first.json()
+        # Pinecone and OpenAI are only called for the first request
+        assert mocks.index.query.call_count == 1
+        assert mocks.llm.ainvoke.call_count == 1
+    
+    def test_query_pinecone_error(self, client, mocks, dummy_embedding):
         """Test query when Pinecone API fails"""
         # Mock embedding
-        mock_embedding.embed_query.return_value = [0.1] * 384
+        mocks.embedding_model.embed_documents.side_effect = lambda texts: [dummy_embedding] * len(texts)
         
         # Mock Pinecone to raise an error
-        mock_index.query.side_effect = Exception("Pinecone API error")
+        mocks.index.query.side_effect = Exception("Pinecone API error")
         
         response = client.post(
             "/query",
-            json={"query": "Test question"}
+            content=_Q_BODY,
+            headers=_Q_HEADERS
         )
         
         assert response.status_code == 500
@@ -252,98 +183,330 @@ class TestQueryEndpoint:
         assert "Error querying database" in data["detail"]
 
 
-class TestResponseModels:
-    """Tests for Pydantic models"""
+def parse_sse(body):
+    """Parse a Server-Sent Events body into a list of (event, data) tuples"""
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+class TestQueryStreamEndpoint:
+    """Tests for the streaming query endpoint"""
     
-    def test_query_request_model(self):
-        """Test QueryRequest model validation"""
-        from main import QueryRequest
+    def test_stream_tokens(self, client, mocks, dummy_embedding, high_score_matches):
+        """Test that the score is sent first, followed by the streamed answer"""
+        # Mock embedding
+        mocks.embedding_model.embed_documents.side_effect = lambda texts: [dummy_embedding] * len(texts)
         
-        # Valid request
-        request = QueryRequest(query="How to fix a washing machine?")
-        assert request.query == "How to fix a washing machine?"
+        # Mock Pinecone query response with good scores
+        mocks.index.query.return_value = high_score_matches
         
-        # Empty string should be allowed (validation happens at API level)
-        request_empty = QueryRequest(query="")
-        assert request_empty.query == ""
-    
-    def test_query_response_model(self):
-        """Test QueryResponse model"""
-        from main import QueryResponse
-        
-        # Valid response with answer
-        response = QueryResponse(
-            answer="Test answer",
-            total_score=75.5
+        # Mock OpenAI streaming response
+        async def mock_astream(messages):
+            for content in ["Check ", "the drain hose."]:
+                yield SimpleNamespace(content=content)
+        mocks.llm.astream.side_effect = mock_astream
+        
+        response = client.post(
+            "/query/stream",
+            content=_Q_BODY,
+            headers=_Q_HEADERS
         )
-        assert response.answer == "Test answer"
-        assert response.total_score == 75.5
         
-        # Response with None answer
-        response_none = QueryResponse(
-            answer=None,
-            total_score=30.0
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        events = parse_sse(response.text)
+        assert events[0][0] == "score"
+        assert events[0][1]["total_score"] > 25.0
+        assert [data["content"] for event, data in events if event == "token"] == ["Check ", "the drain hose."]
+        assert events[-1][0] == "done"
+    
+    def test_stream_low_score_fallback(self, client, mocks, dummy_embedding, low_score_matches):
+        """Test that a low score streams the fallback message without calling OpenAI"""
+        # Mock embedding
+        mocks.embedding_model.embed_documents.side_effect = lambda texts: [dummy_embedding] * len(texts)
+        
+        # Mock Pinecone query response with low scores
+        mocks.index.query.return_value = low_score_matches
+        
+        response = client.post(
+            "/query/stream",
+            content=_UNRELATED_Q_BODY,
+            headers=_Q_HEADERS
         )
-        assert response_none.answer is None
-        assert response_none.total_score == 30.0
+        
+        assert response.status_code == 200
+        events = parse_sse(response.text)
+        assert events[0] == ("score", {"total_score": pytest.approx(10.0)})
+        assert events[1] == ("token", {"content": "I could not find enough information about this issue in the dataset."})
+        assert events[-1][0] == "done"
+
+
+# (path, request kwargs, expected status) for requests rejected before any model work
+VALIDATION_CASES = [
+    ("/query", {"json": {}}, 422),
+    ("/query", {"content": "invalid json"}, 422),
+    ("/query", {"json": {"query": ""}}, 400),
+    ("/query", {"json": {"query": "  a  "}}, 400),
+    ("/query/stream", {"json": {"query": ""}}, 400),
+]
 
 
-class TestScoreCalculation:
-    """Tests for score calculation logic"""
+class TestRequestValidation:
+    """Tests for requests rejected by validation"""
     
-    @patch('main.index')
-    @patch('main.embedding_model')
-    def test_score_calculation_average(self, mock_embedding, mock_index):
-        """Test that score is calculated as average percentage"""
-        # Mock embedding
-        mock_embedding.embed_query.return_value = [0.1] * 384
+    async def test_invalid_requests_rejected(self, mocks):
+        """Test missing fields, invalid JSON and trivial queries in one event loop pass"""
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            responses = await asyncio.gather(
+                *[ac.post(path, **kwargs) for path, kwargs, _ in VALIDATION_CASES]
+            )
         
-        # Mock Pinecone query with specific scores
-        mock_index.query.return_value = {
-            'matches': [
-                {
-                    'score': 0.5,
-                    'metadata': {
-                        'text': 'Text 1',
-                        'source': 'test.pdf',
-                        'chunk_index': 1
-                    }
-                },
-                {
-                    'score': 0.6,
-                    'metadata': {
-                        'text': 'Text 2',
-                        'source': 'test2.pdf',
-                        'chunk_index': 2
-                    }
-                },
-                {
-                    'score': 0.4,
-                    'metadata': {
-                        'text': 'Text 3',
-                        'source': 'test3.pdf',
-                        'chunk_index': 3
-                    }
-                }
-            ]
-        }
+        for (path, kwargs, expected_status), response in zip(VALIDATION_CASES, responses):
+            assert response.status_code == expected_status, (path, kwargs)
+            if expected_status == 400:
+                assert "at least" in response.json()["detail"]
         
-        with patch('main.prompt') as mock_prompt, patch('main.llm') as mock_llm:
-            mock_prompt.format_messages.return_value = [MagicMock()]
-            mock_ai_response = MagicMock()
-            mock_ai_response.content = "Answer"
-            mock_llm.invoke.return_value = mock_ai_response
-            
-            response = client.post(
-                "/query",
-                json={"query": "Test"}
-            )
+        # Rejected before any embedding or Pinecone work
+        mocks.embedding_model.embed_documents.assert_not_called()
+        mocks.index.query.assert_not_called()
+
+
+class TestCacheWarmUp:
+    """Tests for the startup cache warm-up"""
+    
+    async def test_warm_up_answers_each_query(self, tmp_path):
+        """Test that every warm-up query is answered once, stored for other workers, and failures are tolerated"""
+        warm_queries = tmp_path / "warm_queries.json"
+        warm_queries.write_text(json.dumps(["Dryer not heating", "Oven not heating"]))
         
-        assert response.status_code == 200
-        data = response.json()
-        # Average of 0.5, 0.6, 0.4 = 0.5, so percentage = 50.0
-        expected_score = ((0.5 + 0.6 + 0.4) / 3) * 100
-        assert abs(data["total_score"] - expected_score) < 0.01
+        mock_answer = AsyncMock(side_effect=[
+            main.QueryResponse(answer="Check the heating element", total_score=60.0),
+            Exception("OpenAI API error")
+        ])
+        mock_embed = AsyncMock(return_value=[0.1] * 384)
+        with patch('main.WARM_QUERIES_PATH', str(warm_queries)), \
+                patch('main.answer_query', mock_answer), patch('main.embed_query', mock_embed):
+            await main.warm_semantic_cache()
+        
+        assert sorted(call.args[0] for call in mock_answer.await_args_list) == ["Dryer not heating", "Oven not heating"]
+        stored = [main.warm_answer_store.get(query) for query in ["Dryer not heating", "Oven not heating"]]
+        assert [entry[1:] for entry in stored if entry is not None] == [("Check the heating element", 60.0)]
+    
+    async def test_warm_up_claims_only_questions_being_answered(self, tmp_path):
+        """Test that questions queued behind WARM_UP_CONCURRENCY are not claimed yet"""
+        warm_queries = tmp_path / "warm_queries.json"
+        warm_queries.write_text(json.dumps(["Dryer not heating", "Oven not heating", "Fridge too warm"]))
+        open_claims = []
+        
+        async def answer(query):
+            open_claims.append(main.warm_answer_store._connection().execute(
+                "SELECT COUNT(*) FROM warm_answers WHERE total_score IS NULL"
+            ).fetchone()[0])
+            return main.QueryResponse(answer="Check the heating element", total_score=60.0)
+        
+        with patch('main.WARM_QUERIES_PATH', str(warm_queries)), patch('main.WARM_UP_CONCURRENCY', 1), \
+                patch('main.answer_query', AsyncMock(side_effect=answer)), \
+                patch('main.embed_query', AsyncMock(return_value=[0.1] * 384)):
+            await main.warm_semantic_cache()
+        
+        assert open_claims == [1, 1, 1]
+    
+    async def test_warm_up_loads_stored_answers(self, tmp_path):
+        """Test that answers stored by another worker are loaded without calling Pinecone or OpenAI"""
+        warm_queries = tmp_path / "warm_queries.json"
+        warm_queries.write_text(json.dumps(["Dryer not heating"]))
+        main.warm_answer_store.claim("Dryer not heating")
+        main.warm_answer_store.put("Dryer not heating", [0.1] * 384, "Check the heating element", 60.0)
+        
+        mock_answer = AsyncMock()
+        with patch('main.WARM_QUERIES_PATH', str(warm_queries)), patch('main.answer_query', mock_answer):
+            await main.warm_semantic_cache()
+        
+        mock_answer.assert_not_awaited()
+        assert main.semantic_cache.get([0.1] * 384) == ("Check the heating element", 60.0)
+    
+    async def test_warm_up_disabled(self):
+        """Test that an empty WARM_QUERIES_PATH disables warm-up"""
+        mock_answer = AsyncMock()
+        with patch('main.WARM_QUERIES_PATH', ""), patch('main.answer_query', mock_answer):
+            await main.warm_semantic_cache()
+        
+        mock_answer.assert_not_awaited()
+
+
+class TestEmbeddingKVCache:
+    """Tests for the persistent query embedding cache"""
+    
+    def test_put_get_normalizes_text(self):
+        """Test that embeddings round-trip and lookups ignore case and extra whitespace"""
+        cache = main.EmbeddingKVCache(":memory:")
+        cache.put("Dryer not heating", [0.5] * 384)
+        
+        assert cache.get("  dryer   NOT heating ").tolist() == [0.5] * 384
+        assert cache.get("Oven not heating") is None
+    
+    def test_least_recently_used_entries_evicted(self):
+        """Test that the cache is pruned back to max_entries, dropping the least recently used rows"""
+        cache = main.EmbeddingKVCache(":memory:", max_entries=2)
+        cache.PRUNE_EVERY = 1
+        cache.put("Dryer not heating", [0.1] * 384)
+        cache.put("Oven not heating", [0.2] * 384)
+        with patch('main.time.time', return_value=time.time() + 60):
+            cache.get("Dryer not heating")
+            cache.put("Fridge too warm", [0.3] * 384)
+        
+        assert cache.get("Oven not heating") is None
+        assert cache.get("Dryer not heating") is not None
+        assert cache.get("Fridge too warm") is not None
+    
+    def test_lookup_not_blocked_by_another_writer(self, tmp_path):
+        """Test that a hit is returned at once while another worker holds the write lock"""
+        path = str(tmp_path / "embedding_cache.sqlite3")
+        cache = main.EmbeddingKVCache(path)
+        cache.put("Dryer not heating", [0.5] * 384)
+        
+        other_worker = sqlite3.connect(path)
+        other_worker.execute("BEGIN IMMEDIATE")
+        try:
+            start = time.perf_counter()
+            assert cache.get("Dryer not heating").tolist() == [0.5] * 384
+            assert time.perf_counter() - start < 1.0
+        finally:
+            other_worker.rollback()
+            other_worker.close()
+    
+    def test_sqlite_errors_are_cache_misses(self, tmp_path):
+        """Test that an unusable database file is treated as a miss instead of raising"""
+        cache = main.EmbeddingKVCache(str(tmp_path))  # a directory cannot be opened as a database
+        cache.put("Dryer not heating", [0.5] * 384)
+        
+        assert cache.get("Dryer not heating") is None
+
+
+class TestSemanticCache:
+    """Tests for the in-memory semantic answer cache"""
+    
+    def test_threshold_boundary(self):
+        """Test that a query just above the similarity threshold hits and one just below misses"""
+        cache = main.SemanticCache(dim=2, threshold=0.9)
+        cache.put([1.0, 0.0], "Check the heating element", 60.0)
+        
+        assert cache.get([0.91, np.sqrt(1 - 0.91 ** 2)]) == ("Check the heating element", 60.0)
+        assert cache.get([0.89, np.sqrt(1 - 0.89 ** 2)]) is None
+        # Lookups compare directions, not magnitudes
+        assert cache.get([5.0, 0.0]) == ("Check the heating element", 60.0)
+    
+    def test_ring_buffer_overwrites_oldest(self):
+        """Test that inserting past max_entries replaces the oldest entry"""
+        cache = main.SemanticCache(dim=3, threshold=0.99, max_entries=2)
+        cache.put([1.0, 0.0, 0.0], "first", 10.0)
+        cache.put([0.0, 1.0, 0.0], "second", 20.0)
+        cache.put([0.0, 0.0, 1.0], "third", 30.0)
+        
+        assert len(cache) == 2
+        assert cache.get([1.0, 0.0, 0.0]) is None
+        assert cache.get([0.0, 1.0, 0.0]) == ("second", 20.0)
+        assert cache.get([0.0, 0.0, 1.0]) == ("third", 30.0)
+    
+    def test_nan_query_misses(self):
+        """Test that a non-finite query embedding never matches a cached answer"""
+        cache = main.SemanticCache(dim=2)
+        cache.put([1.0, 0.0], "answer", 50.0)
+        
+        assert cache.get([float("nan"), 0.0]) is None
+    
+    def test_clear(self):
+        """Test that clear() empties the cache"""
+        cache = main.SemanticCache(dim=2)
+        cache.put([1.0, 0.0], "answer", 50.0)
+        cache.clear()
+        
+        assert len(cache) == 0
+        assert cache.get([1.0, 0.0]) is None
+
+
+class TestOnnxMiniLMEmbeddings:
+    """Tests for the ONNX Runtime query embedder"""
+    
+    @pytest.mark.parametrize(
+        "input_names",
+        [["input_ids", "attention_mask", "token_type_ids"], ["input_ids", "attention_mask"]],
+        ids=["with_token_type_ids", "without_token_type_ids"]
+    )
+    def test_mean_pooling_skips_padding_and_normalizes(self, input_names):
+        """Test that padded tokens are left out of the mean and each embedding has unit norm"""
+        tokenizer = Mock()
+        tokenizer.encode_batch.return_value = [
+            SimpleNamespace(ids=[101, 7, 102], attention_mask=[1, 1, 1], type_ids=[0, 0, 0]),
+            SimpleNamespace(ids=[101, 102, 0], attention_mask=[1, 1, 0], type_ids=[0, 0, 0])
+        ]
+        session = Mock()
+        session.get_inputs.return_value = [SimpleNamespace(name=name) for name in input_names]
+        # The last token of the second text is padding, with values far off its real tokens
+        session.run.return_value = [np.array([
+            [[3.0, 4.0], [3.0, 4.0], [3.0, 4.0]],
+            [[0.0, 2.0], [0.0, 4.0], [100.0, -100.0]]
+        ], dtype=np.float32)]
+        
+        with patch('main.ort') as mock_ort, patch('main.Tokenizer') as mock_tokenizer:
+            mock_ort.InferenceSession.return_value = session
+            mock_tokenizer.from_file.return_value = tokenizer
+            embedder = main.OnnxMiniLMEmbeddings("minilm_int8")
+        
+        embeddings = embedder.embed_documents(["Dryer not heating", "Oven"])
+        
+        assert embeddings.dtype == np.float32
+        assert np.allclose(embeddings, [[0.6, 0.8], [0.0, 1.0]])
+        assert np.allclose(np.linalg.norm(embeddings, axis=1), 1.0)
+        feeds = session.run.call_args.args[1]
+        assert ("token_type_ids" in feeds) == ("token_type_ids" in input_names)
+        assert feeds["attention_mask"].tolist() == [[1, 1, 1], [1, 1, 0]]
+
+
+    def test_zero_pooled_vector_stays_finite(self):
+        """Test that an all-zero hidden state embeds to a zero vector rather than NaN"""
+        tokenizer = Mock()
+        tokenizer.encode_batch.return_value = [
+            SimpleNamespace(ids=[101, 102], attention_mask=[1, 1], type_ids=[0, 0])
+        ]
+        session = Mock()
+        session.get_inputs.return_value = [SimpleNamespace(name="input_ids"), SimpleNamespace(name="attention_mask")]
+        session.run.return_value = [np.zeros((1, 2, 2), dtype=np.float32)]
+        
+        with patch('main.ort') as mock_ort, patch('main.Tokenizer') as mock_tokenizer:
+            mock_ort.InferenceSession.return_value = session
+            mock_tokenizer.from_file.return_value = tokenizer
+            embedder = main.OnnxMiniLMEmbeddings("minilm_int8")
+        
+        assert embedder.embed_documents(["Hi there"]).tolist() == [[0.0, 0.0]]
+
+
+class TestMicroBatcher:
+    """Tests for the embedding micro-batcher"""
+    
+    async def test_concurrent_items_share_one_batch(self):
+        """Test that items submitted within one window are sent as a single batch"""
+        batch_fn = Mock(side_effect=lambda items: [item * 2 for item in items])
+        batcher = main.MicroBatcher(batch_fn, window=0.01)
+        
+        results = await asyncio.gather(*[batcher.submit(i) for i in range(5)])
+        
+        assert results == [0, 2, 4, 6, 8]
+        batch_fn.assert_called_once_with([0, 1, 2, 3, 4])
+    
+    async def test_batch_error_propagates_to_callers(self):
+        """Test that a failing batch raises in every waiting caller"""
+        batcher = main.MicroBatcher(Mock(side_effect=Exception("Embedding error")), window=0.01)
+        
+        results = await asyncio.gather(
+            batcher.submit("a"), batcher.submit("b"), return_exceptions=True
+        )
+        
+        assert all(isinstance(result, Exception) for result in results)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,38 @@
+import pytest
+from models import QueryRequest, QueryResponse
+
+
+class TestResponseModels:
+    """Tests for Pydantic models"""
+    
+    def test_query_request_model(self):
+        """Test QueryRequest model validation"""
+        # Valid request
+        request = QueryRequest(query="How to fix a washing machine?")
+        assert request.query == "How to fix a washing machine?"
+        
+        # Empty string should be allowed (validation happens at API level)
+        request_empty = QueryRequest(query="")
+        assert request_empty.query == ""
+    
+    def test_query_response_model(self):
+        """Test QueryResponse model"""
+        # Valid response with answer
+        response = QueryResponse(
+            answer="Test answer",
+            total_score=75.5
+        )
+        assert response.answer == "Test answer"
+        assert response.total_score == 75.5
+        
+        # Response with None answer
+        response_none = QueryResponse(
+            answer=None,
+            total_score=30.0
+        )
+        assert response_none.answer is None
+        assert response_none.total_score == 30.0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])